@@ -0,0 +1,76 @@
+import re
+import functools
+
+MD_FENCE_RE = re.compile(r"^[ \t]*```.*$", re.MULTILINE)
+CODE_START_PREFIXES = (
+    "package ", "import ", "@", "/*", "//",
+    "public class", "public final class", "public abstract class",
+    "class ", "final class", "abstract class",
+)
+# Literals and comments are matched (and ignored) so braces inside them
+# don't count towards nesting.
+JAVA_SCAN_RE = re.compile(
+    r'(?P<skip>"""[\s\S]*?"""|"(?:\\.|[^"\\\n])*"'
+    r"|'(?:\\.|[^'\\\n])*'|//[^\n]*|/\*[\s\S]*?\*/)"
+    r"|(?P<open>\{)|(?P<close>\})"
+    r"|(?P<type>^[ \t]*(?:@\w+(?:\([^)\n]*\))?\s+)*"
+    r"(?:(?:public|protected|private|abstract|final|static|sealed|non-sealed|strictfp)\s+)*"
+    r"(?:class|interface|enum|record|@interface)\b)",
+    re.MULTILINE,
+)
+CLASS_PLACEHOLDER = "__CLASS_UNDER_TEST__"
+
+
+def clean_generated_code(code_text: str) -> str:
+    # Keep only the first fenced block when there is one, then drop any prose
+    # before the first unindented line of Java. A lone fence after code is
+    # a closing one; any other lone fence line is simply dropped.
+    fences = list(MD_FENCE_RE.finditer(code_text))
+    if len(fences) > 1:
+        code_text = code_text[fences[0].end():fences[1].start()]
+    elif fences:
+        before, after = code_text[:fences[0].start()], code_text[fences[0].end():]
+        if any(line.startswith(CODE_START_PREFIXES) for line in before.splitlines()):
+            code_text = before
+        else:
+            code_text = before + after
+    lines = code_text.splitlines()
+    start = next((i for i, line in enumerate(lines) if line.startswith(CODE_START_PREFIXES)), 0)
+    return "\n".join(lines[start:]).strip()
+
+
+def is_complete_java(java_code: str) -> bool:
+    # Single pass over the whole buffer: braces must never close below the
+    # top level and must balance at the end, and a top-level type must be
+    # declared. Catches responses cut off by the output token limit.
+    depth = 0
+    has_type = False
+    for match in JAVA_SCAN_RE.finditer(java_code):
+        kind = match.lastgroup
+        if kind == "open":
+            depth += 1
+        elif kind == "close":
+            depth -= 1
+            if depth < 0:
+                return False
+        elif kind == "type" and depth == 0:
+            has_type = True
+    return has_type and depth == 0
+
+
+@functools.lru_cache(maxsize=None)
+def class_name_re(class_name: str) -> re.Pattern:
+    return re.compile(rf"\b{re.escape(class_name)}")
+
+
+def mask_class_name(text: str, class_name: str) -> str:
+    return class_name_re(class_name).sub(CLASS_PLACEHOLDER, text)
+
+
+def read_java_source(path: str, class_name: str) -> tuple:
+    # Runs on the reader thread pool; the structural check is done here so
+    # it overlaps with other reads. A stray non-UTF-8 byte (e.g. a Latin-1
+    # comment) shouldn't abort the run.
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        source_code = f.read()
+    return class_name, source_code, is_complete_java(source_code)
@@ -0,0 +1,31 @@
+import unittest
+
+from java_test_utils import clean_generated_code, is_complete_java
+
+
+class CleanGeneratedCodeTest(unittest.TestCase):
+    def test_lone_closing_fence(self):
+        code = clean_generated_code("public class FooTest {}\n```")
+        self.assertEqual(code, "public class FooTest {}")
+        self.assertTrue(is_complete_java(code))
+
+    def test_lone_opening_fence_truncated(self):
+        code = clean_generated_code("Here is a test:\n```java\npublic class FooTest {\n  @Test void t() {")
+        self.assertEqual(code, "public class FooTest {\n  @Test void t() {")
+        self.assertFalse(is_complete_java(code))
+
+    def test_prose_around_fence(self):
+        code = clean_generated_code("Here is a test:\n```java\npackage a;\nclass FooTest {\n}\n```\nThis test covers the getters.")
+        self.assertEqual(code, "package a;\nclass FooTest {\n}")
+
+    def test_two_blocks_keeps_first(self):
+        code = clean_generated_code("```java\nclass FooTest {}\n```\nAlternatively:\n```java\nclass BarTest {}\n```")
+        self.assertEqual(code, "class FooTest {}")
+
+    def test_indented_annotation_is_not_code_start(self):
+        code = clean_generated_code("Here is a test:\n\nclass FooTest {\n  @Test void t() {}\n}")
+        self.assertEqual(code, "class FooTest {\n  @Test void t() {}\n}")
+
+
+if __name__ == "__main__":
+    unittest.main()
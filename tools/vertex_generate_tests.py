@@ -1,32 +1,474 @@
 import os
+import re
+import json
+import time
+import random
+import asyncio
+import subprocess
+import hashlib
 import argparse
-from google.cloud import aiplatform
+import tempfile
+import textwrap
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import google.auth
+from google.api_core import exceptions
+from google.cloud import aiplatform, storage
+from google.cloud.aiplatform.gapic import PredictionServiceAsyncClient
+from google.protobuf import json_format
+from google.protobuf.struct_pb2 import Value
+from java_test_utils import CLASS_PLACEHOLDER, clean_generated_code, is_complete_java, mask_class_name, read_java_source
 
 PROJECT_ID = "runtime-terror-973009"
 LOCATION = "us-central1"
 MODEL = "text-bison"
+MODEL_ENDPOINT = f"projects/{PROJECT_ID}/locations/{LOCATION}/publishers/google/models/{MODEL}"
+DEFAULT_CONCURRENCY = 8
+DEFAULT_BATCH_SIZE = 4
+MIN_OUTPUT_TOKENS = 1024
+MAX_OUTPUT_TOKENS = 2048  # text-bison's output limit
+MAX_ATTEMPTS = 5
+MAX_BACKOFF_SECONDS = 60
+JAVAC_TIMEOUT_SECONDS = 300
+JAVAC_MAX_ERRORS = 100000  # javac stops reporting after 100 by default
+RETRYABLE_ERRORS = (
+    exceptions.TooManyRequests,
+    exceptions.ResourceExhausted,
+    exceptions.InternalServerError,
+    exceptions.ServiceUnavailable,
+    exceptions.DeadlineExceeded,
+)
+CACHE_DIR = os.path.join(".cache", "vertex_tests")
+SHAPE_CACHE_DIR = os.path.join(".cache", "vertex_shapes")
+QUEUE_SIZE = 64
+READER_WORKERS = 16
+SKIP_RE = re.compile(r"(Test|Tests|Application|Config)\.java$")
 
-aiplatform.init(project=PROJECT_ID, location=LOCATION)
-model = aiplatform.Model(model_name=MODEL)
+# Resolve application default credentials once and share them with the
+# SDK; google-auth refreshes the token shortly before it expires, so long
+# runs don't hit 401s mid-way.
+CREDENTIALS, _ = google.auth.default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
 
-def generate_tests(source_code: str, class_name: str, out_dir: str):
-    prompt = f"""
-    You are an expert Java developer. Write JUnit 5 test cases 
-    with meaningful assertions and edge cases for this class:
+aiplatform.init(project=PROJECT_ID, location=LOCATION, credentials=CREDENTIALS)
 
-    {source_code}
-    """
-    response = model.predict(instances=[{"content": prompt}])
-    test_code = response.predictions[0]
+# Static instructions shared by every request. Kept as a single constant
+# ahead of the per-file source so the prompt prefix is identical across
+# calls and can be reused by any prefix cache on the serving side.
+PROMPT_PREFIX = textwrap.dedent("""\
+    You are an expert Java developer. Write JUnit 5 test cases
+    with meaningful assertions and edge cases for this class.""")
 
+
+def build_prompt(source_code: str, class_name: str) -> str:
+    # Per-class details go after the source so nothing variable precedes it.
+    return f"{PROMPT_PREFIX}\n\nSource code:\n{source_code.strip()}\n\nName the test class {class_name}Test."
+
+
+def should_skip_file(file_name: str) -> bool:
+    return bool(SKIP_RE.search(file_name))
+
+
+def iter_java_files(source_dir: str):
+    with os.scandir(source_dir) as it:
+        entries = sorted(it, key=lambda entry: entry.name)
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield from iter_java_files(entry.path)
+        elif entry.name.endswith(".java") and entry.is_file() and not should_skip_file(entry.name):
+            yield entry.path, entry.name[:-5]  # drop .java
+
+
+def test_file_path(class_name: str, out_dir: str) -> str:
+    return os.path.join(out_dir, f"{class_name}Test.java")
+
+
+def is_up_to_date(path: str, class_name: str, out_dir: str) -> bool:
+    # Make-style freshness check: a test newer than its source is kept as is.
+    test_file = test_file_path(class_name, out_dir)
+    return os.path.exists(test_file) and os.path.getmtime(test_file) >= os.path.getmtime(path)
+
+
+def max_output_tokens(batch: list) -> int:
+    # Decode budget scales with the largest class in the batch (~4 chars
+    # per token) so small DTOs don't reserve the model's full output limit.
+    source_tokens = max(len(source_code) for _, source_code, _, _ in batch) // 4
+    return max(MIN_OUTPUT_TOKENS, min(MAX_OUTPUT_TOKENS, 4 * source_tokens + 512))
+
+
+def cache_path(prompt: str) -> str:
+    key = hashlib.sha256((MODEL + prompt).encode("utf-8")).hexdigest()
+    return os.path.join(CACHE_DIR, f"{key}.java")
+
+
+# The process umask, read once (os.umask can only be read by setting it).
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+def write_atomic(path: str, text: str):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    # mkstemp creates the file as 0600 and os.replace keeps that mode; give
+    # it the mode a plain open() would have.
+    os.fchmod(fd, 0o666 & ~UMASK)
+    # Encode once and write the bytes directly, skipping the text-mode
+    # TextIOWrapper layer.
+    with os.fdopen(fd, "wb") as f:
+        f.write(text.encode("utf-8"))
+    os.replace(tmp, path)
+
+
+def write_test(test_code: str, class_name: str, out_dir: str) -> str:
     os.makedirs(out_dir, exist_ok=True)
-    test_file = os.path.join(out_dir, f"{class_name}Test.java")
-    with open(test_file, "w", encoding="utf-8") as f:
-        f.write(test_code)
+    test_file = test_file_path(class_name, out_dir)
+    write_atomic(test_file, test_code)
+    return test_file
+
+
+def shape_cache_path(source_code: str, class_name: str) -> str:
+    # Classes that differ only in their name and formatting (typical for
+    # DTO/entity boilerplate) share a key, so one generated test can be
+    # reused for all of them after renaming.
+    shape = " ".join(mask_class_name(source_code, class_name).split())
+    key = hashlib.sha256((MODEL + PROMPT_PREFIX + shape).encode("utf-8")).hexdigest()
+    return os.path.join(SHAPE_CACHE_DIR, f"{key}.java")
+
+
+def load_cached(class_name: str, cache_file: str, shape_file: str, out_dir: str) -> bool:
+    if cache_file and os.path.exists(cache_file):
+        with open(cache_file, "r", encoding="utf-8") as f:
+            test_code = f.read()
+    elif os.path.exists(shape_file):
+        with open(shape_file, "r", encoding="utf-8") as f:
+            test_code = f.read().replace(CLASS_PLACEHOLDER, class_name)
+    else:
+        return False
+    test_file = write_test(test_code, class_name, out_dir)
+    print(f"♻️  Cached: {test_file}")
+    return True
+
+
+def prediction_text(prediction) -> str:
+    # text-bison predictions are {"content": ..., "safetyAttributes": ...,
+    # "citationMetadata": ...}; only the generated text is needed.
+    if isinstance(prediction, str):
+        return prediction
+    if hasattr(prediction, "get"):
+        content = prediction.get("content")
+        return content if isinstance(content, str) else ""
+    return ""
+
+
+@functools.lru_cache(maxsize=None)
+def prediction_client() -> PredictionServiceAsyncClient:
+    # A single client for the whole run, created lazily inside the event
+    # loop: its gRPC (HTTP/2) channel is shared by every request instead
+    # of paying a new TLS handshake per call.
+    return PredictionServiceAsyncClient(
+        credentials=CREDENTIALS,
+        client_options={"api_endpoint": f"{LOCATION}-aiplatform.googleapis.com"},
+    )
+
+
+async def predict_with_retry(instances: list, parameters: dict) -> list:
+    # Exponential backoff with full jitter, so concurrent batches that hit
+    # the quota together don't all retry in lockstep.
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            response = await prediction_client().predict(
+                endpoint=MODEL_ENDPOINT,
+                instances=[json_format.ParseDict(instance, Value()) for instance in instances],
+                parameters=json_format.ParseDict(parameters, Value()),
+            )
+            return list(response.predictions)
+        except RETRYABLE_ERRORS as e:
+            if attempt == MAX_ATTEMPTS:
+                raise
+            delay = random.uniform(0, min(MAX_BACKOFF_SECONDS, 2 ** attempt))
+            print(f"⏳ {type(e).__name__}, retrying in {delay:.1f}s (attempt {attempt}/{MAX_ATTEMPTS})")
+            await asyncio.sleep(delay)
+
+
+def is_truncated(prediction, max_tokens: int) -> bool:
+    # A non-empty response that isn't complete Java most likely ran out of
+    # output tokens, which only a larger budget can fix.
+    return max_tokens < MAX_OUTPUT_TOKENS and bool(prediction_text(prediction).strip())
+
+
+async def generate_tests(batch: list, out_dir: str, max_tokens: int) -> tuple:
+    # One predict() call carries an instance per class, so a batch of K
+    # classes costs a single round trip instead of K.
+    prompts = [build_prompt(source_code, class_name) for class_name, source_code, _, _ in batch]
+    predictions = await predict_with_retry(
+        instances=[{"prompt": prompt} for prompt in prompts],
+        parameters={"maxOutputTokens": max_tokens},
+    )
+
+    test_files = {}
+    truncated = []
+    for item, prediction in zip(batch, predictions):
+        test_file = store_prediction(prediction, item, out_dir)
+        if test_file:
+            test_files[test_file] = item
+        elif is_truncated(prediction, max_tokens):
+            truncated.append(item)
+    return test_files, truncated
+
+
+def store_prediction(prediction, item: tuple, out_dir: str):
+    class_name, _, cache_file, shape_file = item
+    test_code = prediction_text(prediction)
+    if not test_code.strip():
+        # Never cache a malformed response, or every rerun would reuse it.
+        print(f"⚠️  Empty response for: {class_name}")
+        return None
+    test_code = clean_generated_code(test_code)
+    if not is_complete_java(test_code):
+        print(f"⚠️  Incomplete response for: {class_name}")
+        return None
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    os.makedirs(SHAPE_CACHE_DIR, exist_ok=True)
+    write_atomic(cache_file, test_code)
+    write_atomic(shape_file, mask_class_name(test_code, class_name))
+    test_file = write_test(test_code, class_name, out_dir)
     print(f"✅ Generated: {test_file}")
+    return test_file
+
+
+def run_batch_job(sources: list, out_dir: str, gcs_prefix: str) -> tuple:
+    # One Vertex AI batch prediction job for the whole run instead of a
+    # request per batch: cheaper per token and no per-request overhead,
+    # at the cost of waiting for the job to be scheduled.
+    prompts = {}
+    for item in sources:
+        class_name, source_code, _, _ = item
+        prompts[build_prompt(source_code, class_name)] = item
+    bucket_name, _, prefix = gcs_prefix.removeprefix("gs://").partition("/")
+    run_prefix = "/".join(part for part in (prefix.strip("/"), f"generate-tests-{int(time.time())}") if part)
+    max_tokens = max_output_tokens(sources)
+    try:
+        client = storage.Client(project=PROJECT_ID, credentials=CREDENTIALS)
+        bucket = client.bucket(bucket_name)
+        bucket.blob(f"{run_prefix}/input.jsonl").upload_from_string(
+            "\n".join(json.dumps({"prompt": prompt}) for prompt in prompts),
+            content_type="application/jsonl",
+        )
+
+        print(f"Submitting batch prediction job for {len(prompts)} classes")
+        aiplatform.BatchPredictionJob.create(
+            job_display_name=os.path.basename(run_prefix),
+            model_name=f"publishers/google/models/{MODEL}",
+            instances_format="jsonl",
+            predictions_format="jsonl",
+            gcs_source=f"gs://{bucket_name}/{run_prefix}/input.jsonl",
+            gcs_destination_prefix=f"gs://{bucket_name}/{run_prefix}/output",
+            model_parameters={"maxOutputTokens": max_tokens},
+            sync=True,
+        )
+    except (exceptions.GoogleAPIError, RuntimeError) as e:
+        # Like a failed realtime batch: report it and let the run go on to
+        # the same-shape fill-in and the compile check.
+        for class_name, _, _, _ in prompts.values():
+            print(f"❌ Failed: {class_name} (batch prediction job: {e})")
+        return {}, []
+
+    # Output lines echo their instance, which maps them back to the class.
+    test_files = {}
+    truncated = []
+    try:
+        for blob in client.list_blobs(bucket_name, prefix=f"{run_prefix}/output"):
+            if not blob.name.endswith(".jsonl"):
+                continue
+            for line in blob.download_as_text().splitlines():
+                try:
+                    result = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                prompt = (result.get("instance") or {}).get("prompt") if isinstance(result, dict) else None
+                if prompt not in prompts:
+                    continue
+                item = prompts.pop(prompt)
+                predictions = result.get("predictions") or [None]
+                test_file = store_prediction(predictions[0], item, out_dir)
+                if test_file:
+                    test_files[test_file] = item
+                elif is_truncated(predictions[0], max_tokens):
+                    truncated.append(item)
+    except exceptions.GoogleAPIError as e:
+        print(f"⚠️  Could not read all batch prediction output ({e})")
+    for class_name, _, _, _ in prompts.values():
+        print(f"❌ Failed: {class_name} (missing from batch prediction output)")
+    return test_files, truncated
+
+
+async def generate_tests_async(batch: list, out_dir: str, max_tokens: int = None) -> dict:
+    class_names = ", ".join(class_name for class_name, _, _, _ in batch)
+    print(f"Generating tests for: {class_names}")
+    try:
+        test_files, truncated = await generate_tests(batch, out_dir, max_tokens or max_output_tokens(batch))
+    except exceptions.GoogleAPIError as e:
+        if isinstance(e, RETRYABLE_ERRORS) or len(batch) == 1:
+            # A batch that still fails after retrying shouldn't abort the
+            # rest; splitting it would only send more requests into the
+            # quota or outage that caused the failure.
+            print(f"❌ Failed: {class_names} ({e})")
+            return {}
+        # One bad class (e.g. an input the model rejects) fails the whole
+        # request, so retry the classes one by one to isolate it.
+        print(f"⚠️  Batch failed, retrying individually: {class_names} ({e})")
+        test_files = {}
+        for item in batch:
+            test_files.update(await generate_tests_async([item], out_dir, max_tokens))
+        return test_files
+    if truncated:
+        # Retried once with the model's full output budget; is_truncated()
+        # is never true at that budget, so this can't recurse further.
+        test_files.update(await retry_truncated(truncated, out_dir, len(batch)))
+    return test_files
+
+
+async def retry_truncated(truncated: list, out_dir: str, batch_size: int) -> dict:
+    print(f"⚠️  Retrying with {MAX_OUTPUT_TOKENS} output tokens: {', '.join(class_name for class_name, _, _, _ in truncated)}")
+    test_files = {}
+    for i in range(0, len(truncated), batch_size):
+        test_files.update(await generate_tests_async(truncated[i:i + batch_size], out_dir, MAX_OUTPUT_TOKENS))
+    return test_files
+
+
+def evict_cached(cache_file: str, shape_file: str):
+    for cached in (cache_file, shape_file):
+        if os.path.exists(cached):
+            os.remove(cached)
+
+
+def verify_tests(test_files: list, classpath: str) -> set:
+    # A single javac run for every generated test: JVM startup dominates
+    # compiling one small file, so per-file invocations cost N startups.
+    try:
+        with tempfile.TemporaryDirectory() as classes_dir:
+            result = subprocess.run(
+                ["javac", "-Xmaxerrs", str(JAVAC_MAX_ERRORS), "-d", classes_dir, "-cp", classpath, *test_files],
+                capture_output=True,
+                text=True,
+                timeout=JAVAC_TIMEOUT_SECONDS,
+            )
+    except FileNotFoundError:
+        print("⚠️  javac not found, skipping compile check")
+        return set()
+    except subprocess.TimeoutExpired:
+        print(f"⚠️  javac timed out after {JAVAC_TIMEOUT_SECONDS}s, skipping compile check")
+        return set()
+    if result.returncode == 0:
+        print(f"✅ Compiled: {len(test_files)} generated tests")
+        return set()
+    # javac prefixes each diagnostic with the path it was given.
+    failed = {line.split(":", 1)[0] for line in result.stderr.splitlines()} & set(test_files)
+    for test_file in sorted(failed):
+        print(f"❌ Does not compile: {test_file}")
+    print(result.stderr)
+    return failed
+
+
+async def scan_sources(source_dir: str, out_dir: str, use_cache: bool, readers: ThreadPoolExecutor, read_q: asyncio.Queue):
+    # Reads start on the pool as soon as a file is found; the bounded queue
+    # keeps the scan from running too far ahead of the consumers.
+    loop = asyncio.get_running_loop()
+    for path, class_name in iter_java_files(source_dir):
+        if use_cache and is_up_to_date(path, class_name, out_dir):
+            continue
+        await read_q.put(loop.run_in_executor(readers, read_java_source, path, class_name))
+    await read_q.put(None)
+
+
+async def batch_sources(out_dir: str, use_cache: bool, batch_size: int, workers: int,
+                        read_q: asyncio.Queue, batch_q: asyncio.Queue, duplicates: list):
+    # Reads are awaited in scan order so batches are deterministic.
+    batch = []
+    seen_shapes = set()
+    while (read := await read_q.get()) is not None:
+        class_name, code, is_valid = await read
+        if not is_valid:
+            # Not worth an LLM call: no top-level type (e.g. package-info)
+            # or braces that don't balance.
+            print(f"⚠️  Skipping: {class_name} (not a complete Java type)")
+            continue
+        # Both cache keys hash the whole source, so they're computed once
+        # here and carried with the class through the rest of the pipeline.
+        cache_file = cache_path(build_prompt(code, class_name))
+        shape_file = shape_cache_path(code, class_name)
+        if use_cache and load_cached(class_name, cache_file, shape_file, out_dir):
+            continue
+        item = (class_name, code, cache_file, shape_file)
+        if shape_file in seen_shapes:
+            duplicates.append(item)
+            continue
+        seen_shapes.add(shape_file)
+        batch.append(item)
+        if len(batch) == batch_size:
+            await batch_q.put(batch)
+            batch = []
+    if batch:
+        await batch_q.put(batch)
+    for _ in range(workers):
+        await batch_q.put(None)
 
 
-if _name_ == "_main_":
+async def generate_worker(out_dir: str, batch_q: asyncio.Queue, generated: dict):
+    while (batch := await batch_q.get()) is not None:
+        generated.update(await generate_tests_async(batch, out_dir))
+
+
+async def collect_worker(batch_q: asyncio.Queue, sources: list):
+    while (batch := await batch_q.get()) is not None:
+        sources.extend(batch)
+
+
+async def main(source_dir: str, out_dir: str, concurrency: int, batch_size: int, use_cache: bool,
+               verify_classpath: str, batch_job_gcs_prefix: str):
+    # scan -> read -> batch -> generate, connected by bounded queues so disk
+    # I/O overlaps with requests in flight; the number of generate workers
+    # caps concurrent Vertex AI requests.
+    read_q = asyncio.Queue(maxsize=QUEUE_SIZE)
+    batch_q = asyncio.Queue(maxsize=concurrency)
+    duplicates = []
+    generated = {}
+    if batch_job_gcs_prefix:
+        # Batch prediction mode: gather every pending class, then submit them as one job.
+        pending = []
+        workers = [collect_worker(batch_q, pending)]
+    else:
+        workers = [generate_worker(out_dir, batch_q, generated) for _ in range(concurrency)]
+    with ThreadPoolExecutor(max_workers=READER_WORKERS) as readers:
+        await asyncio.gather(
+            scan_sources(source_dir, out_dir, use_cache, readers, read_q),
+            batch_sources(out_dir, use_cache, batch_size, len(workers), read_q, batch_q, duplicates),
+            *workers,
+        )
+    if batch_job_gcs_prefix and pending:
+        generated, truncated = await asyncio.to_thread(run_batch_job, pending, out_dir, batch_job_gcs_prefix)
+        if truncated:
+            generated.update(await retry_truncated(truncated, out_dir, batch_size))
+
+    # Same-shape classes are filled in only from shape entries written by
+    # this run, never from an older exact or shape entry (which --no_cache
+    # promises to ignore, and which may be stale when generation failed).
+    written_shapes = {shape_file for _, _, _, shape_file in generated.values()}
+    for item in duplicates:
+        class_name, _, _, shape_file = item
+        if shape_file in written_shapes and load_cached(class_name, None, shape_file, out_dir):
+            generated[test_file_path(class_name, out_dir)] = item
+        else:
+            print(f"❌ Failed: {class_name} (no test generated for a class of the same shape)")
+
+    if verify_classpath is not None and generated:
+        # Known-bad output is dropped so the next run regenerates it instead
+        # of reusing it from the cache or treating it as up to date.
+        for test_file in verify_tests(list(generated), verify_classpath):
+            _, _, cache_file, shape_file = generated[test_file]
+            evict_cached(cache_file, shape_file)
+            os.remove(test_file)
+
+
+if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--source_dir",
@@ -38,13 +480,41 @@ if _name_ == "_main_":
         default="src/test/java/generated_tests",
         help="Where to write generated tests"
     )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help="Maximum number of Vertex AI requests in flight"
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help="Number of classes sent to Vertex AI in a single request"
+    )
+    parser.add_argument(
+        "--no_cache",
+        action="store_true",
+        help="Ignore previously cached responses and regenerate every test"
+    )
+    parser.add_argument(
+        "--verify_classpath",
+        default=None,
+        help="Compile the newly generated tests with javac against this classpath"
+    )
+    parser.add_argument(
+        "--batch_job_gcs_prefix",
+        default=None,
+        help="gs:// prefix for a Vertex AI batch prediction job; when set, all classes are submitted as one job"
+    )
     args = parser.parse_args()
 
-    for root, _, files in os.walk(args.source_dir):
-        for file in files:
-            if file.endswith(".java"):
-                class_name = file[:-5]  # drop .java
-                with open(os.path.join(root, file), "r", encoding="utf-8") as f:
-                    code = f.read()
-                print(f"Generating tests for: {class_name}")
-                generate_tests(code, class_name, args.out_dir)
+    asyncio.run(main(
+        args.source_dir,
+        args.out_dir,
+        args.concurrency,
+        args.batch_size,
+        not args.no_cache,
+        args.verify_classpath,
+        args.batch_job_gcs_prefix,
+    ))